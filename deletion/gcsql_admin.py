@@ -1,12 +1,45 @@
 """sample helper class for working with the Cloud SQL admin API
 """
+import copy
+import functools
 import os
+import threading
+import types
+import weakref
 from typing import List
 
+import cachetools  # pylint: disable=E0401
+import google_auth_httplib2  # pylint: disable=E0401
 import googleapiclient.discovery  # pylint: disable=E0401
+import googleapiclient.http  # pylint: disable=E0401
 
 from config import APP_CREDENTIALS
 
+# Recommended best practice is to create a service account for the app
+# and set the GOOGLE_APPLICATION_CREDENTIALS environment variable to
+# point to the app registration JSON for the service account.
+
+# If the environment variable is not set but a filename has been specified
+# in the APP_CREDENTIALS setting in config.py, those credentials are used.
+# Note that APP_CREDENTIALS should contain the name of an app registration
+# JSON file in the current working directory.
+_ENV_VAR = "GOOGLE_APPLICATION_CREDENTIALS"
+if not os.environ.get(_ENV_VAR) and APP_CREDENTIALS:
+    os.environ[_ENV_VAR] = os.path.abspath(APP_CREDENTIALS)
+
+# If neither of the above options is provided, your current Google identity
+# will be used. Not recommended, and a warning will be displayed.
+
+# Constant fields shared by the database and user insert request bodies,
+# read-only so no caller can change them for later inserts.
+# "sql#user" is what Databases.insert has always sent; it is kept as is on
+# purpose rather than silently changing the request body.
+_INSERT_BODY_TEMPLATE = types.MappingProxyType({"kind": "sql#user", "etag": ""})
+
+# short-lived cache of Instances.get results, keyed on (project, instance)
+_instance_cache = cachetools.TTLCache(maxsize=128, ttl=5)
+_instance_cache_lock = threading.Lock()
+
 
 class CloudSqlAdmin:
     """Wrapper class for the Cloud SQL admin APIs
@@ -23,8 +56,6 @@ class CloudSqlAdmin:
 
         self.service: googleapiclient.discovery.Resource = service_client()
 
-        self.response: dict = {}  # response to the last API call
-
 
 class Databases:
     """Handles database API calls as a contained member of CloudSqlAdmin.
@@ -59,11 +90,10 @@ class Databases:
             project=project, instance=instance, database=database
         )
         try:
-            self.admin.response = request.execute()
+            response = request.execute()
         except googleapiclient.errors.HttpError:
-            self.admin.response = {"error": "googleapiclient.errors.HttpError"}
             return False
-        if self.admin.response.get("error", ""):
+        if response.get("error", ""):
             return False
         return True
 
@@ -85,10 +115,9 @@ class Databases:
             project=project, instance=instance, database=database
         )
         try:
-            self.admin.response = request.execute()
+            return request.execute()
         except googleapiclient.errors.HttpError:
-            self.admin.response = {}
-        return self.admin.response
+            return {}
 
     def insert(
         self,
@@ -115,12 +144,11 @@ class Databases:
             True if success, false if error occurred.
         """
         request_body = {
-            "kind": "sql#user",
+            **_INSERT_BODY_TEMPLATE,
             "name": database,
             "charset": charset,
             "project": project,
             "instance": instance,
-            "etag": "",
             "collation": collation,
             "selfLink": selflink,
         }
@@ -128,8 +156,8 @@ class Databases:
         request = self.admin.service.databases().insert(
             project=project, instance=instance, body=request_body
         )
-        self.admin.response = request.execute()
-        if self.admin.response.get("error", ""):
+        response = request.execute()
+        if response.get("error", ""):
             return False
         return True
 
@@ -148,8 +176,7 @@ class Databases:
         request = self.admin.service.databases().list(
             project=project, instance=instance
         )
-        self.admin.response = request.execute()
-        return self.admin.response["items"]
+        return request.execute()["items"]
 
 
 class Instances:
@@ -179,16 +206,18 @@ class Instances:
         Returns:
             True if instance is successfully deleted, False if an error occurs.
         """
+        with _instance_cache_lock:
+            _instance_cache.pop((project, instance), None)
+
         request: googleapiclient.http.HttpRequest
         request = self.admin.service.instances().delete(
             project=project, instance=instance
         )
         try:
-            self.admin.response = request.execute()
+            response = request.execute()
         except googleapiclient.errors.HttpError:
-            self.admin.response = {"error": "googleapiclient.errors.HttpError"}
             return False
-        if self.admin.response.get("error", ""):
+        if response.get("error", ""):
             return False
         return True
 
@@ -203,14 +232,25 @@ class Instances:
             An instance object (dict) as documented here:
             https://developers.google.com/resources/api-libraries/documentation/sqladmin/v1beta4/python/latest/sqladmin_v1beta4.instances.html#get
             If an error occurred, the returned dict is empty.
+
+        Successful results are cached for a few seconds, so bursts of calls
+        for the same instance share a single API request. Each call gets its
+        own copy, so callers may modify the result freely.
         """
+        with _instance_cache_lock:
+            metadata = _instance_cache.get((project, instance))
+        if metadata is not None:
+            return copy.deepcopy(metadata)
+
         request: googleapiclient.http.HttpRequest
         request = self.admin.service.instances().get(project=project, instance=instance)
         try:
-            self.admin.response = request.execute()
+            response = request.execute()
         except googleapiclient.errors.HttpError:
-            self.admin.response = {}
-        return self.admin.response
+            return {}
+        with _instance_cache_lock:
+            _instance_cache[(project, instance)] = copy.deepcopy(response)
+        return response
 
     def insert(
         self,
@@ -267,8 +307,8 @@ class Instances:
         request = self.admin.service.instances().insert(
             project=project, body=request_body
         )
-        self.admin.response = request.execute()
-        if self.admin.response.get("error", ""):
+        response = request.execute()
+        if response.get("error", ""):
             return False
         return True
 
@@ -288,10 +328,10 @@ class Instances:
         request = self.admin.service.instances().list(project=project)
 
         while request is not None:
-            self.admin.response = request.execute()
-            sql_instances.extend(self.admin.response["items"])
+            response = request.execute()
+            sql_instances.extend(response["items"])
             request = self.admin.service.instances().list_next(
-                previous_request=request, previous_response=self.admin.response
+                previous_request=request, previous_response=response
             )
 
         return sql_instances
@@ -331,11 +371,10 @@ class Users:
             project=project, instance=instance, host=host, name=username
         )
         try:
-            self.admin.response = request.execute()
+            response = request.execute()
         except googleapiclient.errors.HttpError:
-            self.admin.response = {"error": "googleapiclient.errors.HttpError"}
             return False
-        if self.admin.response.get("error", ""):
+        if response.get("error", ""):
             return False
         return True
 
@@ -357,20 +396,19 @@ class Users:
             True if success, false if error occurred.
         """
         request_body = {
-            "kind": "sql#user",
+            **_INSERT_BODY_TEMPLATE,
             "name": username,
             "project": project,
             "instance": instance,
             "host": host,
-            "etag": "",
             "password": password,
         }
         request: googleapiclient.http.HttpRequest
         request = self.admin.service.users().insert(
             project=project, instance=instance, body=request_body
         )
-        self.admin.response = request.execute()
-        if self.admin.response.get("error", ""):
+        response = request.execute()
+        if response.get("error", ""):
             return False
         return True
 
@@ -386,15 +424,46 @@ class Users:
         """
         request: googleapiclient.http.HttpRequest
         request = self.admin.service.users().list(project=project, instance=instance)
-        self.admin.response = request.execute()
-        return self.admin.response["items"]
+        return request.execute()["items"]
+
+
+_thread_local = threading.local()
+
 
+def _thread_request(http, *args, **kwargs) -> googleapiclient.http.HttpRequest:
+    """Builds an API request bound to the calling thread's own Http object.
 
+    httplib2.Http is not thread-safe, so a service resource shared across
+    request handlers must not share its connection. Each thread gets its own
+    authorized Http (and keep-alive connection) per service resource on first
+    use, built with the client library's default timeout and redirect codes.
+
+    Args:
+        http: the service resource's authorized Http; its credentials are reused
+
+    Returns:
+        googleapiclient.http.HttpRequest - the request, ready to execute.
+    """
+    if not hasattr(_thread_local, "http"):
+        _thread_local.http = weakref.WeakKeyDictionary()
+    thread_http = _thread_local.http.get(http)
+    if thread_http is None:
+        thread_http = google_auth_httplib2.AuthorizedHttp(
+            http.credentials, http=googleapiclient.http.build_http()
+        )
+        _thread_local.http[http] = thread_http
+    return googleapiclient.http.HttpRequest(thread_http, *args, **kwargs)
+
+
+@functools.lru_cache(maxsize=4)
 def service_client(
     name: str = "sqladmin", version: str = "v1beta4"
 ) -> googleapiclient.discovery.Resource:
     """Creates the Cloud SLQL admin API service resource object.
 
+    The resource is built once per (name, version) and reused afterwards,
+    since building it from the discovery document is expensive.
+
     Args:
         name: the service name
         version: the API version
@@ -404,19 +473,10 @@ def service_client(
         sqladmin resource, ready to use.
     """
 
-    # Recommended best practice is to create a service account for the app
-    # and set the GOOGLE_APPLICATION_CREDENTIALS environment variable to
-    # point to the app registration JSON for the service account.
-
-    # If the environment variable is not set but a filename has been specified
-    # in the APP_CREDENTIALS setting in config.py, those credentials are used.
-    # Note that APP_CREDENTIALS should contain the name of an app registration
-    # JSON file in the current working directory.
-    env_var = "GOOGLE_APPLICATION_CREDENTIALS"
-    if not os.environ.get(env_var) and APP_CREDENTIALS:
-        os.environ[env_var] = f"{os.getcwd()}\\{APP_CREDENTIALS}"
-
-    # If neither of the above options is provided, your current Google identity
-    # will be used. Not recommended, and a warning will be displayed.
-
-    return googleapiclient.discovery.build(name, version)
+    return googleapiclient.discovery.build(
+        name,
+        version,
+        cache_discovery=False,
+        static_discovery=True,
+        requestBuilder=_thread_request,
+    )
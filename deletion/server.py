@@ -3,6 +3,11 @@ from flask import Flask, request
 from flask import Response
 from werkzeug.datastructures import ImmutableDict
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import RLock
+from cachetools import TTLCache, cached
 import datetime
 import base64
 import os
@@ -10,122 +15,160 @@ from pprint import pprint
 from time import sleep
 from timeit import default_timer
 from gcsql_admin import CloudSqlAdmin
-import sys
+import logging
 import google.auth.transport.requests
 import google.oauth2.id_token
 import google.auth
+import googleapiclient.errors
 import json
-from googleapiclient import discovery
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
 
 app = Flask('post method')
 
+# shared across requests so outgoing calls reuse pooled keep-alive connections.
+# every handler thread (gunicorn --threads in the Dockerfile) fans out to all
+# webhooks at once, so the pool holds one connection per thread and webhook
+HANDLER_THREADS = 16
+WEBHOOKS_PER_ALERT = 4
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=8, pool_maxsize=HANDLER_THREADS * WEBHOOKS_PER_ALERT,
+                       max_retries=Retry(total=2, backoff_factor=0.1))
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# webhook fan-out: per-call timeout, and the shared deadline for all of them
+WEBHOOK_TIMEOUT = 3
+WEBHOOK_DEADLINE = WEBHOOK_TIMEOUT
+
 from config import MY_PROJECT, RUN_URL
 
+# built once per process; discovery.build is far too expensive to run per alert
+SQL_ADMIN = CloudSqlAdmin()
+SERVICE = SQL_ADMIN.service
+
+# the replica inventory changes rarely; 2 minutes matches the alerting cadence
+AUTOREP_CACHE = TTLCache(maxsize=4, ttl=120)
+AUTOREP_LOCK = RLock()
+
+@cached(AUTOREP_CACHE, lock=AUTOREP_LOCK)
+def _find_autorep(project):
+    # only the first match is ever used, so stop paging at the first hit
+    requestA = SERVICE.instances().list(project=project)
+    while requestA is not None:
+        responseA = requestA.execute()
+        for database_instance in responseA.get('items', []):
+            if 'autorep' in database_instance['name']:
+                return database_instance['name']
+        requestA = SERVICE.instances().list_next(previous_request=requestA, previous_response=responseA)
+    return None
+
+# seconds to let proxysql stop routing to a replica before it is deleted
+DRAIN_SECONDS = 10
+
+# ID tokens are valid for an hour, keep them for 55 minutes
+@cached(TTLCache(maxsize=2, ttl=3300), lock=RLock())
+def _id_token(audience):
+    auth_req = google.auth.transport.requests.Request()
+    return google.oauth2.id_token.fetch_id_token(auth_req, audience)
+
 @app.route("/proxysql", methods=["POST"])
 def proxy():
     envelope = request.get_json()
     if not envelope:
         msg = "no Pub/Sub message received"
-        print(f"error: {msg}")
+        logger.error(msg)
         return f"Bad Request: {msg}", 400
 
     if not isinstance(envelope, dict) or "message" not in envelope:
         msg = "invalid Pub/Sub message format"
-        print(f"error: {msg}")
+        logger.error(msg)
         return f"Bad Request: {msg}", 400
 
     pubsub_message = envelope["message"]
 
-    name = "World"
-    if isinstance(pubsub_message, dict) and "data" in pubsub_message:
-        name = base64.b64decode(pubsub_message["data"]).decode("utf-8").strip()
-        # return ("", 204)
-
-    print(f"Hello {name}!")
-    sys.stdout.flush()
-    msg = json.loads(name)
-    print(type(msg))
-    sys.stdout.flush()
-    credentials, project_id = google.auth.default()
-    credentials.refresh(google.auth.transport.requests.Request())
-    service = discovery.build('sqladmin', 'v1beta4', credentials=credentials)
-    ans = []
-    print(type(ans))
-    sys.stdout.flush()
-    requestA = service.instances().list(project=MY_PROJECT)
-    while requestA is not None:
-        responseA = requestA.execute()
-    #    print(type(response))
-        for database_instance in responseA['items']:
-            # TODO: Change code below to process each `database_instance` resource:
-    #        pprint(database_instance['name'])
-            if 'autorep' in database_instance['name']:
-                ans.append(database_instance['name'])
-
-        requestA = service.instances().list_next(previous_request=requestA, previous_response=responseA)
-    if len(ans) >= 1:
-        print(ans[0])
-        sys.stdout.flush()
-        MY_INSTANCE = ans[0]
-
-        print("Check {}",msg["incident"]["state"])
-        sys.stdout.flush()
+    data_b64 = pubsub_message.get("data") if isinstance(pubsub_message, dict) else None
+    if not data_b64:
+        return ("", 204)
+    msg = json.loads(base64.b64decode(data_b64))
+    MY_INSTANCE = _find_autorep(MY_PROJECT)
+    if MY_INSTANCE is not None:
+        logger.info("replica %s, incident state %s", MY_INSTANCE, msg["incident"]["state"])
         if msg["incident"]["state"] == 'open':
             start_time = default_timer()
-            sql_admin = CloudSqlAdmin()
-            sleep(10)
-            print('start')
-            sys.stdout.flush()
-            metadata = sql_admin.instances.get(MY_PROJECT, MY_INSTANCE)
-            state = metadata["state"]
+            metadata = SQL_ADMIN.instances.get(MY_PROJECT, MY_INSTANCE)
+            state = metadata.get("state")
+            if state is None:
+                # the cached replica is gone (deleted elsewhere); forget it and
+                # ack, the next alert will look the replicas up again
+                logger.warning("replica %s not found", MY_INSTANCE)
+                with AUTOREP_LOCK:
+                    AUTOREP_CACHE.clear()
+                status_code = Response(status=200)
+                return status_code
             if state == "RUNNABLE" :
                 private_ip = metadata["ipAddresses"][0]["ipAddress"]
                 payload="{\n    \"name\": \"%s\"\n}" % private_ip
-                print(payload)
-                sys.stdout.flush() 
+                logger.debug("webhook payload %s", payload)
                 headers = {
                     'Content-Type': 'application/json'
                 }
                 # Change URLs with your webhook server URLs for deletion
                 url = ["http://10.14.1.5:9001/hooks/webhook2-vm02","http://10.14.1.4:9001/hooks/webhook2-vm01","http://10.14.1.6:9001/hooks/webhook2-vm03","http://10.14.0.7:9001/hooks/webhook-del-vm01"]
+                # webhooks are independent, fire them concurrently. The pool is
+                # per request so overlapping alerts never queue behind each other
+                executor = ThreadPoolExecutor(max_workers=len(url))
+                futures = {
+                    executor.submit(SESSION.post, u, headers=headers, data=payload,
+                                    timeout=WEBHOOK_TIMEOUT): u
+                    for u in url
+                }
+                done, pending = wait(futures, timeout=WEBHOOK_DEADLINE)
+                executor.shutdown(wait=False)
+                failed = []
+                for future in pending:
+                    logger.warning("webhook %s: no response after %ss", futures[future], WEBHOOK_DEADLINE)
+                    failed.append(futures[future])
+                for future in done:
+                    if future.exception() is not None:
+                        logger.warning("webhook %s: %s", futures[future], future.exception())
+                        failed.append(futures[future])
+                    else:
+                        status = future.result().status_code
+                        logger.info("webhook %s: %s", futures[future], status)
+                        if not 200 <= status < 300:
+                            failed.append(futures[future])
+                # proxysql may still route to the replica, so keep it. Ack anyway:
+                # a redelivered alert would re-fire every webhook and could delete
+                # the replica long after the incident has closed
+                if failed:
+                    logger.error("not deleting %s, webhooks failed: %s", MY_INSTANCE, ", ".join(failed))
+                    status_code = Response(status=200)
+                    return status_code
                 try:
-                    for i in url:         
-                        response = requests.request("POST", i, headers=headers, data=payload)
-                        print(response)
-                        sys.stdout.flush()
-                    print('after webhook')
-                    sys.stdout.flush()
-                    sleep(10)
-                    # credentials, project_id = google.auth.default()
-                    # credentials.refresh(google.auth.transport.requests.Request())
-                    auth_req = google.auth.transport.requests.Request()
-                    id_token = google.oauth2.id_token.fetch_id_token(auth_req, RUN_URL)
-                    print('id_token')
-                    sys.stdout.flush()
-                    print('after second token')
-                    sys.stdout.flush()
+                    # the webhook receivers expose no readiness signal, so give
+                    # proxysql a fixed window to drain the replica before deleting it
+                    sleep(DRAIN_SECONDS)
+                    id_token = _id_token(RUN_URL)
                     headers = {
                         "Authorization": "Bearer {}".format(id_token), 
                         "Content-Type": "application/json"
                     }
-                    # print('after webhook')
-                    # sys.stdout.flush()
-                    print('trigger delete')
-                    sys.stdout.flush()
-                    response = requests.post(RUN_URL + "/delete/" + MY_INSTANCE, timeout=1, headers=headers)
-                    print(response)
-                    sys.stdout.flush()
+                    logger.info("triggering delete of %s", MY_INSTANCE)
+                    # the replica is going away, don't hand it out again from cache
+                    with AUTOREP_LOCK:
+                        AUTOREP_CACHE.clear()
+                    response = SESSION.post(RUN_URL + "/delete/" + MY_INSTANCE, timeout=1, headers=headers)
+                    logger.info("delete trigger: %s", response.status_code)
                 except requests.Timeout:
-                    print('timed out')
-                    sys.stdout.flush()
+                    logger.warning("timed out")
                 status_code = Response(status=200)
                 return status_code
         else:
-            print("status not open")
-            sys.stdout.flush()
+            logger.info("status not open")
     else:
-        print("minimum count reached")
-        sys.stdout.flush()
+        logger.info("minimum count reached")
         status_code = Response(status=200)
         return status_code
         # exit()
@@ -133,25 +176,18 @@ def proxy():
 @app.route("/delete/<instance>", methods=["POST"])
 def index(instance):
 
-    url = 'https://sqladmin.googleapis.com/sql/v1beta4/projects/{}/instances/{}'.format(MY_PROJECT,instance)
-    # name = "my instance"
-    print('point after create')
-    credentials, project_id = google.auth.default()
-    credentials.refresh(google.auth.transport.requests.Request())
-    headers = {
-        "Authorization": "Bearer {}".format(credentials.token), 
-        "Content-Type": "application/json"
-    }
-    print('deleting')
-    x = requests.delete(url,headers=headers)
-    print(x)
-    sleep(600)
-    # print(x.text)
-    # sys.stdout.flush()
-    print('second token')
-    sys.stdout.flush()
+    logger.info("deleting %s", instance)
+    # deletion is a long-running operation that Cloud SQL finishes server-side,
+    # no need to hold this worker until it is done
+    try:
+        operation = SERVICE.instances().delete(project=MY_PROJECT, instance=instance).execute()
+    except googleapiclient.errors.HttpError as err:
+        logger.error("delete of %s failed: %s", instance, err)
+        status_code = Response(status=500)
+        return status_code
+    logger.info("delete operation %s started for %s", operation.get("name"), instance)
     status_code = Response(status=200)
     return status_code
 
 if __name__ == '__main__':
-    app.run(host = '0.0.0.0', port = 8080, debug = True)
\ No newline at end of file
+    app.run(host = '0.0.0.0', port = 8080)
\ No newline at end of file